@@ -7,13 +7,63 @@
 # 4) The stopped services are restarted.
 # 5) STORAGE_ROOT/backup/after-backup is executed if it exists.
 
-import os, os.path, re, datetime, sys
+import os, os.path, re, datetime, sys, functools, subprocess, collections, bisect
+from concurrent.futures import ThreadPoolExecutor
 import dateutil.parser, dateutil.relativedelta, dateutil.tz
 import rtyaml
 from exclusiveprocess import Lock
 
 from utils import load_environment, shell, wait_for_service
 
+# The PATH given to processes we run with subprocess directly, the same sane
+# one that utils.shell() sets.
+SUBPROCESS_PATH = "/sbin:/bin:/usr/sbin:/usr/bin"
+
+# Matches the lines of `duplicity collection-status` that describe a backup set,
+# e.g. " full 20230101T030000Z 3 enc", capturing the type, date and volume count.
+_STATUS_RE = re.compile(r'^ (full|inc)\s+(\S+)\s+(\d+)')
+
+# Matches the names of the files duplicity stores on the target for a backup set.
+_TARGET_FILE_RE = re.compile(r"duplicity-(full|full-signatures|(inc|new-signatures)\.(?P<incbase>\d+T\d+Z)\.to)\.(?P<date>\d+T\d+Z)\.")
+
+@functools.lru_cache(maxsize=1024)
+def parse_duplicity_date(date):
+	# Duplicity always writes dates in UTC in a fixed compact ISO 8601 form,
+	# which strptime parses much faster than dateutil's general parser. Fall
+	# back to dateutil in case some version of duplicity does otherwise.
+	try:
+		return datetime.datetime.strptime(date, "%Y%m%dT%H%M%SZ").replace(tzinfo=datetime.timezone.utc)
+	except ValueError:
+		return dateutil.parser.parse(date)
+
+# How reldate formats differences of less than four weeks, by the number of
+# seconds at which each format starts. Under four weeks a relativedelta never
+# has a months part, so its days, hours and minutes can be had by division.
+_RELDATE_SHORT_LIMIT = 28*24*60*60
+_RELDATE_SHORT_FORMATS = (
+	(0, lambda days, hours, minutes: "%d hours, %d minutes" % (hours, minutes)),
+	(1*24*60*60, lambda days, hours, minutes: "%d day, %d hours" % (days, hours)),
+	(2*24*60*60, lambda days, hours, minutes: "%d days, %d hours" % (days, hours)),
+	(7*24*60*60, lambda days, hours, minutes: "%d days" % days),
+)
+_RELDATE_SHORT_THRESHOLDS = [threshold for threshold, _ in _RELDATE_SHORT_FORMATS]
+
+def reldate(date, ref, clip):
+	if ref < date: return clip
+	delta = ref - date
+	seconds = delta.days*24*60*60 + delta.seconds
+	if seconds < _RELDATE_SHORT_LIMIT:
+		_, fmt = _RELDATE_SHORT_FORMATS[bisect.bisect_right(_RELDATE_SHORT_THRESHOLDS, seconds) - 1]
+		days, rem = divmod(seconds, 24*60*60)
+		hours, rem = divmod(rem, 60*60)
+		return fmt(days, hours, rem // 60)
+	rd = dateutil.relativedelta.relativedelta(ref, date)
+	if rd.years > 1: return "%d years, %d months" % (rd.years, rd.months)
+	if rd.years == 1: return "%d year, %d months" % (rd.years, rd.months)
+	if rd.months > 1: return "%d months, %d days" % (rd.months, rd.days)
+	if rd.months == 1: return "%d month, %d days" % (rd.months, rd.days)
+	return "%d days" % rd.days
+
 def backup_status(env):
 	# If backups are dissbled, return no status.
 	config = get_backup_config(env)
@@ -28,50 +78,45 @@ def backup_status(env):
 	backup_root = os.path.join(env["STORAGE_ROOT"], 'backup')
 	backup_cache_dir = os.path.join(backup_root, 'cache')
 
-	def reldate(date, ref, clip):
-		if ref < date: return clip
-		rd = dateutil.relativedelta.relativedelta(ref, date)
-		if rd.years > 1: return "%d years, %d months" % (rd.years, rd.months)
-		if rd.years == 1: return "%d year, %d months" % (rd.years, rd.months)
-		if rd.months > 1: return "%d months, %d days" % (rd.months, rd.days)
-		if rd.months == 1: return "%d month, %d days" % (rd.months, rd.days)
-		if rd.days >= 7: return "%d days" % rd.days
-		if rd.days > 1: return "%d days, %d hours" % (rd.days, rd.hours)
-		if rd.days == 1: return "%d day, %d hours" % (rd.days, rd.hours)
-		return "%d hours, %d minutes" % (rd.hours, rd.minutes)
-
 	# Get duplicity collection status and parse for a list of backups.
-	def parse_line(line):
-		keys = line.strip().split()
-		date = dateutil.parser.parse(keys[1]).astimezone(dateutil.tz.tzlocal())
+	def parse_line(m):
+		backup_type, backup_date, volumes = m.groups()
+		date = parse_duplicity_date(backup_date).astimezone(dateutil.tz.tzlocal())
 		return {
-			"date": keys[1],
+			"date": backup_date,
 			"date_str": date.strftime("%Y-%m-%d %X") + " " + now.tzname(),
 			"date_delta": reldate(date, now, "the future?"),
-			"full": keys[0] == "full",
+			"full": backup_type == "full",
 			"size": 0, # collection-status doesn't give us the size
-			"volumes": int(keys[2]), # number of archive volumes for this backup (not really helpful)
+			"volumes": int(volumes), # number of archive volumes for this backup (not really helpful)
 		}
 
-	code, collection_status = shell('check_output', [
+	# Stream the output rather than buffering all of it, since it can be long
+	# for large archives. Only the backup rows are kept, plus the last lines
+	# of everything else for the error message in case duplicity fails.
+	duplicity_env_vars = get_duplicity_env_vars(env, config) | { "PATH": SUBPROCESS_PATH }
+	other_output = collections.deque(maxlen=50)
+	with subprocess.Popen([
 		"/usr/bin/duplicity",
 		"collection-status",
 		"--archive-dir", backup_cache_dir,
 		"--gpg-options", "'--cipher-algo=AES256'",
 		"--log-fd", "1",
-		*get_duplicity_additional_args(env),
+		*get_duplicity_additional_args(env, config),
 		get_duplicity_target_url(config)
 		],
-		get_duplicity_env_vars(env),
-		trap=True)
-	if code != 0:
+		stdout=subprocess.PIPE, env=duplicity_env_vars, encoding="utf8") as proc:
+		for line in proc.stdout:
+			m = _STATUS_RE.match(line)
+			if m:
+				backup = parse_line(m)
+				backups[backup["date"]] = backup
+			else:
+				other_output.append(line)
+	if proc.returncode != 0:
 		# Command failed. This is likely due to an improperly configured remote
 		# destination for the backups or the last backup job terminated unexpectedly.
-		raise Exception("Something is wrong with the backup: " + collection_status)
-	for line in collection_status.split('\n'):
-		if line.startswith((" full", " inc")):
-			backup = parse_line(line)
-			backups[backup["date"]] = backup
+		raise Exception("Something is wrong with the backup: " + "".join(other_output))
 
 	# Look at the target directly to get the sizes of each of the backups. There is more than one file per backup.
 	# Starting with duplicity in Ubuntu 18.04, "signatures" files have dates in their
@@ -80,7 +125,7 @@ def backup_status(env):
 	# space is used for those.
 	unmatched_file_size = 0
 	for fn, size in list_target_files(config):
-		m = re.match(r"duplicity-(full|full-signatures|(inc|new-signatures)\.(?P<incbase>\d+T\d+Z)\.to)\.(?P<date>\d+T\d+Z)\.", fn)
+		m = _TARGET_FILE_RE.match(fn)
 		if not m: continue # not a part of a current backup chain
 		key = m.group("date")
 		if key in backups:
@@ -89,26 +134,21 @@ def backup_status(env):
 			unmatched_file_size += size
 
 	# Ensure the rows are sorted reverse chronologically.
-	# This is relied on by should_force_full() and the next step.
+	# This is relied on by the next step.
 	backups = sorted(backups.values(), key = lambda b : b["date"], reverse=True)
 
 	# Get the average size of incremental backups, the size of the
 	# most recent full backup, and the date of the most recent
 	# backup and the most recent full backup.
-	incremental_count = 0
-	incremental_size = 0
+	first_full_index, incremental_count, incremental_size = find_most_recent_full(backups)
 	first_date = None
 	first_full_size = None
 	first_full_date = None
-	for bak in backups:
-		if first_date is None:
-			first_date = dateutil.parser.parse(bak["date"])
-		if bak["full"]:
-			first_full_size = bak["size"]
-			first_full_date = dateutil.parser.parse(bak["date"])
-			break
-		incremental_count += 1
-		incremental_size += bak["size"]
+	if backups:
+		first_date = parse_duplicity_date(backups[0]["date"])
+	if first_full_index is not None:
+		first_full_size = backups[first_full_index]["size"]
+		first_full_date = parse_duplicity_date(backups[first_full_index]["date"])
 
 	# When will the most recent backup be deleted? It won't be deleted if the next
 	# backup is incremental, because the increments rely on all past increments.
@@ -144,7 +184,7 @@ def backup_status(env):
 		elif saw_full and not deleted_in:
 			# We're now on backups prior to the most recent full backup. These are
 			# free to be deleted as soon as they are min_age_in_days old.
-			deleted_in = reldate(now, dateutil.parser.parse(bak["date"]) + datetime.timedelta(days=config["min_age_in_days"]), "on next daily backup")
+			deleted_in = reldate(now, parse_duplicity_date(bak["date"]) + datetime.timedelta(days=config["min_age_in_days"]), "on next daily backup")
 			bak["deleted_in"] = deleted_in
 
 	return {
@@ -152,31 +192,72 @@ def backup_status(env):
 		"unmatched_file_size": unmatched_file_size,
 	}
 
+def find_most_recent_full(backups):
+	# Given backups sorted reverse chronologically, return the index
+	# of the most recent full backup (None if there isn't one) and the
+	# number and total size of the incremental backups after it.
+	incremental_count = 0
+	incremental_size = 0
+	for i, bak in enumerate(backups):
+		if bak["full"]:
+			return i, incremental_count, incremental_size
+		incremental_count += 1
+		incremental_size += bak["size"]
+	return None, incremental_count, incremental_size
+
+def get_target_backups(config):
+	# Reconstruct the list of backups from the names and sizes of the
+	# files on the target alone, without the (slow) duplicity
+	# collection-status call that backup_status makes. The rows have
+	# just the "date", "full" and "size" keys of backup_status's rows
+	# and are likewise sorted reverse chronologically. Signature files
+	# are skipped since their dates don't always line up with the
+	# backup they belong to (see backup_status). duplicity uploads a
+	# backup's manifest after its volumes, so backups without one were
+	# interrupted and are left out, like collection-status does.
+	try:
+		target_files = list_target_files(config)
+	except FileNotFoundError:
+		# A local target directory doesn't exist until the first backup.
+		target_files = []
+	backups = { }
+	for fn, size in target_files:
+		m = _TARGET_FILE_RE.match(fn)
+		if not m or m.group(1) == "full-signatures" or m.group(2) == "new-signatures":
+			continue
+		bak = backups.setdefault(m.group("date"), {
+			"date": m.group("date"),
+			"full": m.group(1) == "full",
+			"size": 0,
+			"complete": False,
+		})
+		bak["size"] += size
+		if fn[m.end():].startswith("manifest"):
+			bak["complete"] = True
+	backups = [bak for bak in backups.values() if bak.pop("complete")]
+	return sorted(backups, key = lambda b : b["date"], reverse=True)
+
 def should_force_full(config, env):
 	# Force a full backup when the total size of the increments
 	# since the last full backup is greater than half the size
-	# of that full backup.
-	inc_size = 0
-	for bak in backup_status(env)["backups"]:
-		if not bak["full"]:
-			# Scan through the incremental backups cumulating
-			# size...
-			inc_size += bak["size"]
-		else:
-			# ...until we reach the most recent full backup.
-			# Return if we should to a full backup, which is based
-			# on the size of the increments relative to the full
-			# backup, as well as the age of the full backup.
-			if inc_size > .5*bak["size"]:
-				return True
-			if dateutil.parser.parse(bak["date"]) + datetime.timedelta(days=config["min_age_in_days"]*10+1) < datetime.datetime.now(dateutil.tz.tzlocal()):
-				return True
-			return False
-	else:
-		# If we got here there are no (full) backups, so make one.
-		# (I love for/else blocks. Here it's just to show off.)
+	# of that full backup. The backups are read off of the
+	# target's file listing.
+	backups = get_target_backups(config)
+	first_full_index, _, inc_size = find_most_recent_full(backups)
+
+	if first_full_index is None:
+		# There are no (full) backups, so make one.
 		return True
 
+	# Decide based on the size of the increments relative to the
+	# full backup, as well as the age of the full backup.
+	bak = backups[first_full_index]
+	if inc_size > .5*bak["size"]:
+		return True
+	if parse_duplicity_date(bak["date"]) + datetime.timedelta(days=config["min_age_in_days"]*10+1) < datetime.datetime.now(dateutil.tz.tzlocal()):
+		return True
+	return False
+
 def get_passphrase(env):
 	# Get the encryption passphrase. secret_key.txt is 2048 random
 	# bits base64-encoded and with line breaks every 65 characters.
@@ -212,10 +293,12 @@ def get_duplicity_target_url(config):
 
 	return target
 
-def get_duplicity_additional_args(env):
-	config = get_backup_config(env)
+def get_duplicity_additional_args(env, config=None):
+	if config is None:
+		config = get_backup_config(env)
 
-	if get_target_type(config) == 'rsync':
+	target_type = get_target_type(config)
+	if target_type == 'rsync':
 		# Extract a port number for the ssh transport.  Duplicity accepts the
 		# optional port number syntax in the target, but it doesn't appear to act
 		# on it, so we set the ssh port explicitly via the duplicity options.
@@ -231,7 +314,7 @@ def get_duplicity_additional_args(env):
 			f"--ssh-options='-i /root/.ssh/id_rsa_miab -p {port}'",
 			f"--rsync-options='-e \"/usr/bin/ssh -oStrictHostKeyChecking=no -oBatchMode=yes -p {port} -i /root/.ssh/id_rsa_miab\"'",
 		]
-	elif get_target_type(config) == 's3':
+	elif target_type == 's3':
 		# See note about hostname in get_duplicity_target_url.
 		# The region name, which is required by some non-AWS endpoints,
 		# is saved inside the username portion of the URL.
@@ -245,8 +328,9 @@ def get_duplicity_additional_args(env):
 
 	return []
 
-def get_duplicity_env_vars(env):
-	config = get_backup_config(env)
+def get_duplicity_env_vars(env, config=None):
+	if config is None:
+		config = get_backup_config(env)
 
 	env = { "PASSPHRASE" : get_passphrase(env) }
 
@@ -257,7 +341,7 @@ def get_duplicity_env_vars(env):
 	return env
 
 def get_target_type(config):
-	return config["target"].split(":")[0]
+	return config["target"].partition(":")[0]
 
 def perform_backup(full_backup):
 	env = load_environment()
@@ -275,6 +359,13 @@ def perform_backup(full_backup):
 	if config["target"] == "off":
 		return
 
+	# Everything duplicity needs to reach the target is the same for
+	# each of its invocations below, so work it out just once.
+	duplicity_args = get_duplicity_additional_args(env, config)
+	duplicity_env_vars = get_duplicity_env_vars(env, config) | { "PATH": SUBPROCESS_PATH }
+	target_url = get_duplicity_target_url(config)
+	target_type = get_target_type(config)
+
 	# On the first run, always do a full backup. Incremental
 	# will fail. Otherwise do a full backup when the size of
 	# the increments since the most recent full backup are
@@ -282,24 +373,50 @@ def perform_backup(full_backup):
 	try:
 		full_backup = full_backup or should_force_full(config, env)
 	except Exception as e:
-		# This was the first call to duplicity, and there might
-		# be an error already.
+		# This was the first time we've looked at the target, and
+		# there might be an error already.
 		print(e)
 		sys.exit(1)
 
+	# Leave a marker while duplicity is working on the target. It's removed
+	# once everything below succeeds, so if it's still here at the start of
+	# a run then the last run failed or was interrupted. Write it before the
+	# services are stopped so a failure here can't leave them down.
+	needs_cleanup_file = os.path.join(backup_root, '.needs_cleanup')
+	needs_cleanup = os.path.exists(needs_cleanup_file)
+	with open(needs_cleanup_file, "w", encoding="utf-8"):
+		pass
+
 	# Stop services.
-	def service_command(service, command, quit=None):
-		# Execute silently, but if there is an error then display the output & exit.
+	def service_command(service, command):
+		# Execute silently, but if there is an error then display the output
+		# and return the exit code.
 		code, ret = shell('check_output', ["/usr/sbin/service", service, command], capture_stderr=True, trap=True)
 		if code != 0:
 			print(ret)
-			if quit:
-				sys.exit(code)
-
-	service_command("php8.0-fpm", "stop", quit=True)
-	service_command("postfix", "stop", quit=True)
-	service_command("dovecot", "stop", quit=True)
-	service_command("postgrey", "stop", quit=True)
+		return code
+
+	def service_commands(services, command):
+		# Run the command for all of the services at once, since each init
+		# script takes a while, and wait for all of them to finish. Returns
+		# the first non-zero exit code, or 0 if they all succeeded.
+		with ThreadPoolExecutor(max_workers=len(services)) as executor:
+			codes = list(executor.map(lambda service: service_command(service, command), services))
+		return next((code for code in codes if code != 0), 0)
+
+	def start_services():
+		# postfix checks mail against postgrey, so start postgrey first.
+		service_command("postgrey", "start")
+		service_commands(["dovecot", "postfix", "php8.0-fpm"], "start")
+
+	# Stop postgrey only once postfix, which relies on it, is down.
+	code = service_commands(["php8.0-fpm", "postfix", "dovecot"], "stop") \
+		or service_command("postgrey", "stop")
+	if code != 0:
+		# Other services may have been stopped alongside the one that failed.
+		# Don't leave mail down when we aren't going to make a backup.
+		start_services()
+		sys.exit(code)
 
 	# Execute a pre-backup script that copies files outside the homedir.
 	# Run as the STORAGE_USER user, not as root. Pass our settings in
@@ -314,7 +431,7 @@ def perform_backup(full_backup):
 	# --allow-source-mismatch is needed in case the box's hostname is changed
 	# after the first backup. See #396.
 	try:
-		shell('check_call', [
+		subprocess.run([
 			"/usr/bin/duplicity",
 			"full" if full_backup else "incr",
 			"--verbosity", "warning", "--no-print-statistics",
@@ -323,52 +440,65 @@ def perform_backup(full_backup):
 			"--volsize", "250",
 			"--gpg-options", "'--cipher-algo=AES256'",
 			"--allow-source-mismatch",
-			*get_duplicity_additional_args(env),
+			*duplicity_args,
 			env["STORAGE_ROOT"],
-			get_duplicity_target_url(config),
+			target_url,
 			],
-			get_duplicity_env_vars(env))
+			env=duplicity_env_vars, check=True)
 	finally:
 		# Start services again.
-		service_command("postgrey", "start", quit=False)
-		service_command("dovecot", "start", quit=False)
-		service_command("postfix", "start", quit=False)
-		service_command("php8.0-fpm", "start", quit=False)
-
-	# Remove old backups. This deletes all backup data no longer needed
-	# from more than 3 days ago.
-	shell('check_call', [
-		"/usr/bin/duplicity",
-		"remove-older-than",
-		"%dD" % config["min_age_in_days"],
-		"--verbosity", "error",
-		"--archive-dir", backup_cache_dir,
-		"--force",
-		*get_duplicity_additional_args(env),
-		get_duplicity_target_url(config)
-		],
-		get_duplicity_env_vars(env))
+		start_services()
+
+	# Change ownership of backups to the user-data user, so that the after-backup
+	# script can access them. This only needs the backup itself to be done, so
+	# let it run while duplicity does its housekeeping below. That can delete
+	# files out from under chown, which then fails (see below), so its errors
+	# are not worth showing.
+	chown_command = ["/bin/chown", "-R", env["STORAGE_USER"], backup_dir]
+	chown = None
+	if target_type == 'file':
+		chown = subprocess.Popen(chown_command, env={ "PATH": SUBPROCESS_PATH }, stderr=subprocess.DEVNULL)
 
-	# From duplicity's manual:
-	# "This should only be necessary after a duplicity session fails or is
-	# aborted prematurely."
-	# That may be unlikely here but we may as well ensure we tidy up if
-	# that does happen - it might just have been a poorly timed reboot.
-	shell('check_call', [
-		"/usr/bin/duplicity",
-		"cleanup",
-		"--verbosity", "error",
-		"--archive-dir", backup_cache_dir,
-		"--force",
-		*get_duplicity_additional_args(env),
-		get_duplicity_target_url(config)
-		],
-		get_duplicity_env_vars(env))
+	try:
+		# Remove old backups. This deletes all backup data no longer needed
+		# from more than 3 days ago.
+		subprocess.run([
+			"/usr/bin/duplicity",
+			"remove-older-than",
+			"%dD" % config["min_age_in_days"],
+			"--verbosity", "error",
+			"--archive-dir", backup_cache_dir,
+			"--force",
+			*duplicity_args,
+			target_url
+			],
+			env=duplicity_env_vars, check=True)
+
+		# From duplicity's manual:
+		# "This should only be necessary after a duplicity session fails or is
+		# aborted prematurely."
+		# So only tidy up if the last run didn't finish - it might just have been
+		# a poorly timed reboot.
+		if needs_cleanup:
+			subprocess.run([
+				"/usr/bin/duplicity",
+				"cleanup",
+				"--verbosity", "error",
+				"--archive-dir", backup_cache_dir,
+				"--force",
+				*duplicity_args,
+				target_url
+				],
+				env=duplicity_env_vars, check=True)
+		os.unlink(needs_cleanup_file)
+	finally:
+		# Wait for the ownership change to finish, even if the housekeeping failed.
+		chown_failed = chown is not None and chown.wait() != 0
 
-	# Change ownership of backups to the user-data user, so that the after-bcakup
-	# script can access them.
-	if get_target_type(config) == 'file':
-		shell('check_call', ["/bin/chown", "-R", env["STORAGE_USER"], backup_dir])
+	# If chown failed, run it again now that nothing else is touching the
+	# backup directory.
+	if chown_failed:
+		subprocess.run(chown_command, env={ "PATH": SUBPROCESS_PATH }, check=True)
 
 	# Execute a post-backup script that does the copying to a remote server.
 	# Run as the STORAGE_USER user, not as root. Pass our settings in
@@ -399,10 +529,10 @@ def run_duplicity_verification():
 		"--compare-data",
 		"--archive-dir", backup_cache_dir,
 		"--exclude", backup_root,
-		*get_duplicity_additional_args(env),
+		*get_duplicity_additional_args(env, config),
 		get_duplicity_target_url(config),
 		env["STORAGE_ROOT"],
-	], get_duplicity_env_vars(env))
+	], get_duplicity_env_vars(env, config))
 
 def run_duplicity_restore(args):
 	env = load_environment()
@@ -412,21 +542,21 @@ def run_duplicity_restore(args):
 		"/usr/bin/duplicity",
 		"restore",
 		"--archive-dir", backup_cache_dir,
-		*get_duplicity_additional_args(env),
+		*get_duplicity_additional_args(env, config),
 		get_duplicity_target_url(config),
 		*args],
-		get_duplicity_env_vars(env))
+		get_duplicity_env_vars(env, config))
 
 def print_duplicity_command():
 	import shlex
 	env = load_environment()
 	config = get_backup_config(env)
 	backup_cache_dir = os.path.join(env["STORAGE_ROOT"], 'backup', 'cache')
-	for k, v in get_duplicity_env_vars(env).items():
+	for k, v in get_duplicity_env_vars(env, config).items():
 		print(f"export {k}={shlex.quote(v)}")
 	print("duplicity", "{command}", shlex.join([
 		"--archive-dir", backup_cache_dir,
-		*get_duplicity_additional_args(env),
+		*get_duplicity_additional_args(env, config),
 		get_duplicity_target_url(config)
 		]))
 
@@ -516,8 +646,12 @@ def list_target_files(config):
 				endpoint_url=f'https://{target.hostname}', \
 				aws_access_key_id=config['target_user'], \
 				aws_secret_access_key=config['target_pass'])
-			bucket_objects = s3.list_objects_v2(Bucket=bucket, Prefix=path)['Contents']
-			backup_list = [(key['Key'][len(path):], key['Size']) for key in bucket_objects]
+			# Each response holds at most 1000 keys, so page through all of them.
+			backup_list = [
+				(key['Key'][len(path):], key['Size'])
+				for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=path)
+				for key in page.get('Contents', [])
+			]
 		except ClientError as e:
 			raise ValueError(e)
 		return backup_list
@@ -580,8 +714,7 @@ def get_backup_config(env, for_save=False, for_ui=False):
 
 	# Merge in anything written to custom.yaml.
 	try:
-		with open(os.path.join(backup_root, 'custom.yaml'), encoding="utf-8") as f:
-			custom_config = rtyaml.load(f)
+		custom_config = load_custom_config(os.path.join(backup_root, 'custom.yaml'))
 		if not isinstance(custom_config, dict): raise ValueError # caught below
 		config.update(custom_config)
 	except:
@@ -611,10 +744,29 @@ def get_backup_config(env, for_save=False, for_ui=False):
 
 	return config
 
+# Parsed custom.yaml files, keyed on path, as (mtime, contents) so a file
+# is only parsed again after it changes.
+_custom_config_cache = { }
+
+def load_custom_config(fn):
+	# Parse the file only if it changed since we last read it. The
+	# returned object is shared between calls, so callers must not
+	# modify it.
+	mtime = os.stat(fn).st_mtime_ns
+	cached = _custom_config_cache.get(fn)
+	if cached is not None and cached[0] == mtime:
+		return cached[1]
+	with open(fn, encoding="utf-8") as f:
+		custom_config = rtyaml.load(f)
+	_custom_config_cache[fn] = (mtime, custom_config)
+	return custom_config
+
 def write_backup_config(env, newconfig):
 	backup_root = os.path.join(env["STORAGE_ROOT"], 'backup')
-	with open(os.path.join(backup_root, 'custom.yaml'), "w", encoding="utf-8") as f:
+	fn = os.path.join(backup_root, 'custom.yaml')
+	with open(fn, "w", encoding="utf-8") as f:
 		f.write(rtyaml.dump(newconfig))
+	_custom_config_cache.pop(fn, None)
 
 if __name__ == "__main__":
 	if sys.argv[-1] == "--verify":